@@ -52,12 +52,18 @@ for file in required_files:
 print("\n5️⃣ Проверка папки downloads:")
 downloads_path = Path('downloads')
 if downloads_path.exists():
-    files = list(downloads_path.glob('*'))
-    print(f"   ✅ Папка существует ({len(files)} файлов)")
-    if files:
-        for f in files[-5:]:  # Показываем последние 5 файлов
-            size_mb = f.stat().st_size / (1024 * 1024)
-            print(f"      - {f.name} ({size_mb:.1f} МБ)")
+    # Бот качает каждый запрос в свою подпапку и удаляет её после отправки,
+    # так что оставшиеся подпапки — брошенные загрузки.
+    # scandir кеширует stat() в DirEntry — один системный вызов на файл
+    with os.scandir(downloads_path) as it:
+        workdirs = [e for e in it if e.is_dir()]
+    workdirs.sort(key=lambda e: e.stat().st_mtime)
+    print(f"   ✅ Папка существует (незавершённых загрузок: {len(workdirs)})")
+    for d in workdirs[-5:]:  # Показываем последние 5 папок
+        with os.scandir(d.path) as it:
+            sizes = [e.stat().st_size for e in it if e.is_file()]
+        size_mb = sum(sizes) / (1024 * 1024)
+        print(f"      - {d.name}/ (файлов: {len(sizes)}, {size_mb:.1f} МБ)")
 else:
     print(f"   ⚠️ Папка downloads не существует (будет создана автоматически)")
 
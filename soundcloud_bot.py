@@ -3,12 +3,27 @@ import os
 import re
 import asyncio
 import json
+import contextlib
+import copy
+import queue
+import shutil
+import sqlite3
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-import urllib.request
+from urllib.parse import parse_qsl, urlencode, urlsplit
+import httpx
 import yt_dlp
-from telegram import Update
+from telegram import InputFile, Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from telegram.constants import ChatAction
+from telegram.error import BadRequest, TelegramError
+
+try:
+    import orjson  # заметно быстрее стандартного json, но необязателен
+except ImportError:
+    orjson = None
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -16,244 +31,673 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "YOUR_BOT_TOKEN_HERE")
+try:
+    OWNER_ID = int(os.getenv("OWNER_ID") or 0) or None  # без него /stats недоступна никому
+except ValueError:
+    logger.warning("OWNER_ID должен быть числовым id пользователя — /stats отключена")
+    OWNER_ID = None
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # внешний https-адрес; если задан — webhook вместо polling
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+WEBHOOK_PATH = "webhook"
+# Telegram присылает его в заголовке каждого обновления — чужие запросы отбрасываются.
+# run_webhook заново регистрирует webhook при каждом запуске, так что случайного значения достаточно
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or uuid.uuid4().hex
+
 DOWNLOAD_FOLDER = "downloads"
-Path(DOWNLOAD_FOLDER).mkdir(exist_ok=True)
+DOWNLOAD_PATH = Path(DOWNLOAD_FOLDER)
+DOWNLOAD_PATH.mkdir(exist_ok=True)
+AUDIO_READ_BUFFER = 1 << 20  # буфер чтения аудио при отправке
+AUDIO_FORMAT = os.getenv("AUDIO_FORMAT", "mp3").lower()  # mp3 (MP3/M4A) или opus
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv("MAX_CONCURRENT_DOWNLOADS", "4"))
+# Загрузка ждёт HEAD-проверку, поэтому дольше не ждём: без ответа всё решит yt-dlp
+TRACK_CHECK_TIMEOUT = 1.5
+
+STATS_DB = "bot_stats.db"
+LEGACY_STATS_FILE = "bot_stats.json"  # старый формат, импортируется в базу при первом запуске
+
+_DB: sqlite3.Connection | None = None
+_STATS_TEXT_CACHE: str | None = None  # готовый текст /stats, сбрасывается при записи
+
+FILE_CACHE_FILE = "file_cache.json"  # track_key -> file_id уже загруженного в Telegram трека
+FILE_CACHE_FLUSH_INTERVAL = 30       # сбрасывать изменения на диск раз в N секунд
+FILE_CACHE_MAX_ENTRIES = 10000       # сверх этого вытесняются давно не запрашивавшиеся треки
+
+_FILE_CACHE: dict | None = None  # порядок ключей — от давно запрошенных к недавним
+_FILE_CACHE_DIRTY = False
+
+# track_key -> Future с (записью кеша file_id, текстом ошибки) для треков, которые качаются прямо сейчас
+_INFLIGHT: dict[str, asyncio.Future] = {}
+
+_RE_SPECIAL = re.compile(r'[^\w\s\-]+')
+_RE_SEPARATORS = re.compile(r'[\s_]+')
 
-STATS_FILE = "bot_stats.json"
+def clean_filename(name: str) -> str:
+    """Очистить имя файла: пробелы -> '_', только буквы, цифры, '-' и '_'"""
+    name = _RE_SPECIAL.sub('', name)
+    # Пробелы и повторяющиеся '_' схлопываются в один '_' за один проход
+    name = _RE_SEPARATORS.sub('_', name)
+    return name.strip('_') or 'track'
 
-def download_soundcloud(url: str) -> tuple[bool, str, dict]:
-    """Скачать трек с SoundCloud"""
+def is_soundcloud_url(url: str) -> bool:
+    """Проверить, что ссылка ведёт на SoundCloud (по домену, а не по подстроке)"""
+    # Ссылку без схемы urlsplit разбирает как путь, поэтому добавляем '//'
     try:
-        logger.info(f"Скачивание: {url}")
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
-            'outtmpl': os.path.join(DOWNLOAD_FOLDER, '%(title)s'),
-            'quiet': False,
-            'no_warnings': False,
-            'keepvideo': False,
-        }
-        
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        parts = urlsplit(url if '//' in url else '//' + url)
+        parts.port  # ValueError, если порт не число
+    except ValueError:
+        return False
+    if parts.scheme not in ('', 'http', 'https'):
+        return False
+    # hostname — настоящий хост после '@', уже в нижнем регистре
+    host = parts.hostname or ''
+    return host == 'soundcloud.com' or host.endswith('.soundcloud.com')
+
+# Параметры, которые SoundCloud меняет при каждом «Поделиться»; на трек не влияют
+_TRACKING_PARAMS = frozenset({'si', 'in', 'ref'})
+
+def track_key(url: str) -> str:
+    """Ключ трека для кешей: хост в нижнем регистре, путь и query без меток отслеживания.
+
+    Остальной query оставляем: у плеера w.soundcloud.com/player/?url=… трек
+    задаётся именно им.
+    """
+    parts = urlsplit(url if '//' in url else '//' + url)
+    query = urlencode([
+        (name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if name not in _TRACKING_PARAMS and not name.startswith('utm_')
+    ])
+    key = f"{parts.hostname}{parts.path.rstrip('/')}"
+    return f"{key}?{query}" if query else key
+
+# FFmpegExtractAudio не трогает поток, который уже в целевом кодеке,
+# поэтому сначала просим у SoundCloud формат, который не нужно перекодировать
+if AUDIO_FORMAT == 'opus':
+    # Opus 64 кбит/с на слух не хуже MP3 192 и весит втрое меньше,
+    # но Telegram принимает его только как голосовое сообщение
+    _FORMAT = 'bestaudio[acodec=opus]/bestaudio/best'
+    _EXTRACT_AUDIO = {
+        'key': 'FFmpegExtractAudio',
+        'preferredcodec': 'opus',
+        'preferredquality': '64',
+    }
+else:
+    _FORMAT = 'bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio/best'
+    _EXTRACT_AUDIO = {
+        'key': 'FFmpegExtractAudio',
+        # AAC только перепаковывается в M4A без перекодирования,
+        # всё остальное конвертируется в MP3
+        'preferredcodec': 'm4a>m4a/mp3',
+        'preferredquality': '128',
+    }
+
+YDL_OPTS = {
+    'format': _FORMAT,
+    # Обложка и теги встраиваются в файл сразу при скачивании
+    'writethumbnail': True,
+    'postprocessors': [
+        _EXTRACT_AUDIO,
+        {'key': 'FFmpegMetadata'},
+        {'key': 'EmbedThumbnail'},
+    ],
+    # Более быстрый режим кодировщика (и LAME, и libopus по умолчанию
+    # работают медленнее): на этих битрейтах разница на слух незаметна
+    'postprocessor_args': {
+        'extractaudio+ffmpeg_o': ['-threads', '0', '-compression_level', '5'],
+    },
+    # SoundCloud отдаёт звук через HLS — сегменты качаем параллельно
+    'concurrent_fragment_downloads': 4,
+    # Ссылка на плейлист или профиль — качаем только первый трек, а не все
+    'playlist_items': '1',
+    # Папка задаётся на каждый запрос через params['paths'] (см. download_soundcloud)
+    'outtmpl': '%(id)s.%(ext)s',
+    'quiet': False,
+    'no_warnings': False,
+    'keepvideo': False,
+}
+
+# YoutubeDL дорого создавать и нельзя делить между потоками,
+# поэтому держим пул готовых экземпляров: по одному на параллельную загрузку
+_YDL_POOL: queue.SimpleQueue = queue.SimpleQueue()
+
+def _acquire_ydl() -> yt_dlp.YoutubeDL:
+    """Взять YoutubeDL из пула или создать новый"""
+    try:
+        return _YDL_POOL.get_nowait()
+    except queue.Empty:
+        # YoutubeDL хранит params по ссылке, а download_soundcloud меняет в них
+        # 'paths' — каждому экземпляру нужна своя копия настроек
+        return yt_dlp.YoutubeDL(copy.deepcopy(YDL_OPTS))
+
+_EXPECTED_YDL_ERRORS = (yt_dlp.utils.DownloadError, yt_dlp.utils.ExtractorError)
+
+def download_soundcloud(url: str, workdir: str) -> tuple[bool, str, dict]:
+    """Скачать трек с SoundCloud в папку workdir"""
+    try:
+        logger.info("Скачивание: %s", url)
+        ydl = _acquire_ydl()
+        try:
+            ydl.params['paths'] = {'home': workdir}
             info = ydl.extract_info(url, download=True)
-            title = info.get('title', '')
-            artist = info.get('uploader', '')
-            thumbnail = info.get('thumbnail', '')
-            
-            # Ищем MP3 файлы
-            mp3_files = list(Path(DOWNLOAD_FOLDER).glob('*.mp3'))
-            if mp3_files:
-                latest = max(mp3_files, key=lambda p: p.stat().st_mtime)
-                return True, str(latest), {
-                    'title': title,
-                    'artist': artist,
-                    'thumbnail': thumbnail,
-                }
-            
-            return False, "MP3 файл не найден", {}
+        finally:
+            _YDL_POOL.put(ydl)
+        
+        if info.get('_type') == 'playlist':
+            entries = [entry for entry in info.get('entries') or [] if entry]
+            if not entries:
+                return False, "В плейлисте нет доступных треков", {}
+            info = entries[0]
+        
+        title = info.get('title', '')
+        artist = info.get('uploader', '')
+        duration = int(info.get('duration') or 0)
+        
+        # Итоговый путь после всех постпроцессоров
+        file_path = Path(info['requested_downloads'][0]['filepath'])
+        if file_path.exists():
+            return True, str(file_path), {
+                'title': title,
+                'artist': artist,
+                'duration': duration,
+            }
+        
+        return False, "Аудиофайл не найден", {}
             
     except Exception as e:
-        logger.error(f"Ошибка: {str(e)}")
+        # Ошибки yt-dlp (удалённый трек, гео-блок) ожидаемы — без трейсбека
+        if isinstance(e, _EXPECTED_YDL_ERRORS):
+            logger.warning("yt-dlp не смог скачать %s: %s", url, e)
+        else:
+            logger.error("Ошибка скачивания %s", url, exc_info=True)
         return False, f"Ошибка: {str(e)}", {}
 
-def download_thumbnail(thumb_url: str) -> str:
-    """Скачать обложку"""
-    if not thumb_url:
-        return None
-    try:
-        thumb_path = os.path.join(DOWNLOAD_FOLDER, 'thumbnail.jpg')
-        urllib.request.urlretrieve(thumb_url, thumb_path)
-        logger.info(f"Обложка: {thumb_path}")
-        return thumb_path
-    except Exception as e:
-        logger.warning(f"Ошибка обложки: {e}")
-        return None
+def _remove_workdir(workdir: Path) -> None:
+    """Удалить папку запроса вместе со всеми файлами"""
+    shutil.rmtree(workdir, ignore_errors=True)
+
+def _json_dumps(data) -> bytes:
+    """Компактный JSON в UTF-8"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def _json_loads(raw: bytes):
+    """Разобрать JSON"""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
 
 # ===== СТАТИСТИКА =====
 
-def load_stats() -> dict:
-    """Загрузить статистику"""
+def _import_json_stats(db: sqlite3.Connection) -> None:
+    """Перенести статистику из старого bot_stats.json в пустую базу"""
+    if not Path(LEGACY_STATS_FILE).exists():
+        return
+    if db.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+        return
     try:
-        if Path(STATS_FILE).exists():
-            with open(STATS_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-    except:
-        pass
-    return {'total_downloads': 0, 'total_users': 0, 'users': {}}
+        stats = _json_loads(Path(LEGACY_STATS_FILE).read_bytes())
+        rows = [
+            (int(user_id), data.get('username') or 'user', data.get('downloads', 0))
+            for user_id, data in stats.get('users', {}).items()
+        ]
+        db.execute("BEGIN")
+        db.executemany("INSERT OR IGNORE INTO users (id, username, downloads) VALUES (?, ?, ?)", rows)
+        db.execute("COMMIT")
+        logger.info("Статистика перенесена из %s: %d пользователей", LEGACY_STATS_FILE, len(rows))
+    except Exception as e:
+        if db.in_transaction:
+            db.execute("ROLLBACK")
+        logger.warning("Не удалось перенести %s: %s", LEGACY_STATS_FILE, e)
 
-def save_stats(stats: dict) -> None:
-    """Сохранить статистику"""
-    try:
-        with open(STATS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(stats, f, ensure_ascii=False, indent=2)
-    except:
-        pass
+def _get_db() -> sqlite3.Connection:
+    """Соединение с базой статистики (открывается один раз)"""
+    global _DB
+    if _DB is None:
+        db = sqlite3.connect(STATS_DB, isolation_level=None, check_same_thread=False)
+        # WAL: каждое обновление — короткая дозапись в журнал, без перезаписи файла
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            "id INTEGER PRIMARY KEY, "
+            "username TEXT NOT NULL, "
+            "downloads INTEGER NOT NULL DEFAULT 0)"
+        )
+        # Индекс поддерживает топ в актуальном состоянии при каждом обновлении,
+        # так что /stats читает первые 5 строк без сортировки всей таблицы
+        db.execute("CREATE INDEX IF NOT EXISTS users_by_downloads ON users (downloads DESC)")
+        _import_json_stats(db)
+        _DB = db
+    return _DB
 
-def update_user_stats(user_id: int, username: str) -> None:
-    """Обновить статистику"""
+def update_user_stats(events: list[tuple[int, str]]) -> None:
+    """Обновить статистику пачкой событий (user_id, username) в одной транзакции"""
+    db = _get_db()
     try:
-        stats = load_stats()
-        
-        if str(user_id) not in stats['users']:
-            stats['total_users'] += 1
-            stats['users'][str(user_id)] = {
-                'username': username or 'user',
-                'downloads': 0,
-            }
-        
-        stats['users'][str(user_id)]['downloads'] += 1
-        stats['total_downloads'] += 1
-        
-        save_stats(stats)
-    except:
-        pass
+        db.execute("BEGIN")
+        db.executemany(
+            "INSERT INTO users (id, username, downloads) VALUES (?, ?, 1) "
+            "ON CONFLICT(id) DO UPDATE SET downloads = downloads + 1",
+            [(user_id, username or 'user') for user_id, username in events],
+        )
+        db.execute("COMMIT")
+    except Exception as e:
+        if db.in_transaction:
+            db.execute("ROLLBACK")
+        logger.warning("Не удалось обновить статистику: %s", e)
+
+async def _stats_writer(stats_queue: asyncio.Queue) -> None:
+    """Единственный писатель статистики: забирает накопившиеся события и пишет их в потоке"""
+    global _STATS_TEXT_CACHE
+    while True:
+        events = [await stats_queue.get()]
+        while not stats_queue.empty():
+            events.append(stats_queue.get_nowait())
+        try:
+            await asyncio.to_thread(update_user_stats, events)
+        finally:
+            # Сбрасываем в event loop, где читается кеш, иначе get_stats_text
+            # мог бы сохранить текст, посчитанный до этой записи
+            _STATS_TEXT_CACHE = None
+            for _ in events:
+                stats_queue.task_done()
 
 def get_stats_text() -> str:
     """Получить текст статистики"""
+    global _STATS_TEXT_CACHE
+    if _STATS_TEXT_CACHE is not None:
+        return _STATS_TEXT_CACHE
     try:
-        stats = load_stats()
-        users = stats.get('users', {})
-        top = sorted(users.items(), key=lambda x: x[1].get('downloads', 0), reverse=True)[:5]
+        db = _get_db()
+        total_users, total_downloads = db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(downloads), 0) FROM users"
+        ).fetchone()
+        top = db.execute(
+            "SELECT username, downloads FROM users ORDER BY downloads DESC LIMIT 5"
+        ).fetchall()
         
-        text = f"📊 СТАТИСТИКА\n🔢 Скачиваний: {stats.get('total_downloads', 0)}\n👥 Пользователей: {stats.get('total_users', 0)}\n\n🏆 ТОП:\n"
-        for i, (_, data) in enumerate(top, 1):
-            text += f"{i}. @{data.get('username')} - {data.get('downloads')} 🎵\n"
+        lines = [f"📊 СТАТИСТИКА\n🔢 Скачиваний: {total_downloads}\n👥 Пользователей: {total_users}\n\n🏆 ТОП:"]
+        lines.extend(
+            f"{i}. @{username} - {downloads} 🎵" for i, (username, downloads) in enumerate(top, 1)
+        )
+        text = "\n".join(lines) + "\n"
+        _STATS_TEXT_CACHE = text
         return text
     except:
         return "❌ Ошибка статистики"
 
+# ===== КЕШ FILE_ID =====
+
+def _write_file_atomic(path: str, data: bytes) -> None:
+    """Записать файл атомарно через временный файл"""
+    tmp_path = path + '.tmp'
+    Path(tmp_path).write_bytes(data)
+    os.replace(tmp_path, path)
+
+def load_file_cache() -> dict:
+    """Загрузить кеш file_id"""
+    try:
+        if Path(FILE_CACHE_FILE).exists():
+            return _json_loads(Path(FILE_CACHE_FILE).read_bytes())
+    except:
+        pass
+    return {}
+
+def save_file_cache(cache: dict) -> None:
+    """Сохранить кеш file_id"""
+    try:
+        _write_file_atomic(FILE_CACHE_FILE, _json_dumps(cache))
+    except:
+        pass
+
+def _get_file_cache() -> dict:
+    """Кеш file_id в памяти (загружается с диска один раз)"""
+    global _FILE_CACHE
+    if _FILE_CACHE is None:
+        _FILE_CACHE = load_file_cache()
+    return _FILE_CACHE
+
+async def _flush_loop() -> None:
+    """Периодически сбрасывать кеш file_id на диск"""
+    global _FILE_CACHE_DIRTY
+    while True:
+        await asyncio.sleep(FILE_CACHE_FLUSH_INTERVAL)
+        if _FILE_CACHE is not None and _FILE_CACHE_DIRTY:
+            # Снимок делаем в event loop (кеш меняется только в нём),
+            # а на диск пишем в отдельном потоке
+            data = _json_dumps(_FILE_CACHE)
+            _FILE_CACHE_DIRTY = False
+            try:
+                await asyncio.to_thread(_write_file_atomic, FILE_CACHE_FILE, data)
+            except Exception as e:
+                logger.warning("Не удалось сохранить %s: %s", FILE_CACHE_FILE, e)
+
+def get_cached_audio(key: str) -> dict | None:
+    """Найти уже отправленный трек по ключу track_key"""
+    global _FILE_CACHE_DIRTY
+    cache = _get_file_cache()
+    entry = cache.pop(key, None)
+    if entry is not None:
+        # Переносим в конец, чтобы вытеснялись давно не запрошенные треки
+        cache[key] = entry
+        _FILE_CACHE_DIRTY = True
+    return entry
+
+def remember_audio(key: str, file_id: str, title: str, voice: bool = False) -> None:
+    """Запомнить file_id отправленного трека"""
+    global _FILE_CACHE_DIRTY
+    entry = {'file_id': file_id, 'title': title}
+    if voice:
+        entry['voice'] = True
+    cache = _get_file_cache()
+    cache.pop(key, None)
+    cache[key] = entry
+    while len(cache) > FILE_CACHE_MAX_ENTRIES:
+        del cache[next(iter(cache))]
+    _FILE_CACHE_DIRTY = True
+
+def forget_audio(key: str) -> None:
+    """Удалить устаревший file_id из кеша"""
+    global _FILE_CACHE_DIRTY
+    if _get_file_cache().pop(key, None) is not None:
+        _FILE_CACHE_DIRTY = True
+
 # ===== КОМАНДЫ =====
 
+WELCOME_TEXT = (
+    "🎵 Добро пожаловать в SoundCloud Music Downloader!\n\n"
+    "Просто отправь мне ссылку на трек с SoundCloud, и я скачаю его для тебя.\n\n"
+    "Команды:\n"
+    "/start - показать это сообщение\n"
+    "/help - справка\n\n"
+    "Пример: https://soundcloud.com/artist/track-name"
+)
+
+# Что именно присылает бот, зависит от AUDIO_FORMAT
+_RESULT_TEXT = (
+    "голосовое сообщение в формате Opus" if AUDIO_FORMAT == 'opus'
+    else "аудиофайл в формате MP3 или M4A"
+)
+
+HELP_TEXT = (
+    "📝 Справка:\n\n"
+    "1. Скопируй ссылку на трек из SoundCloud\n"
+    "2. Отправь её мне в чат\n"
+    "3. Подожди, пока трек скачается\n"
+    f"4. Получи {_RESULT_TEXT}\n\n"
+    "Имя файла будет очищено:\n"
+    "- Пробелы заменены на подчёркивание\n"
+    "- Удалены спецсимволы\n"
+    "- Оставлены только буквы, цифры и дефис"
+)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Команда /start"""
-    welcome_text = (
-        "🎵 Добро пожаловать в SoundCloud Music Downloader!\n\n"
-        "Просто отправь мне ссылку на трек с SoundCloud, и я скачаю его для тебя.\n\n"
-        "Команды:\n"
-        "/start - показать это сообщение\n"
-        "/help - справка\n\n"
-        "Пример: https://soundcloud.com/artist/track-name"
-    )
-    await update.message.reply_text(welcome_text)
+    await update.message.reply_text(WELCOME_TEXT)
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Команда /help"""
-    help_text = (
-        "📝 Справка:\n\n"
-        "1. Скопируй ссылку на трек из SoundCloud\n"
-        "2. Отправь её мне в чат\n"
-        "3. Подожди, пока трек скачается\n"
-        "4. Получи аудиофайл в формате MP3\n\n"
-        "Имя файла будет очищено:\n"
-        "- Пробелы заменены на подчёркивание\n"
-        "- Удалены спецсимволы\n"
-        "- Оставлены только буквы, цифры и дефис"
-    )
-    await update.message.reply_text(help_text)
+    await update.message.reply_text(HELP_TEXT)
 
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Команда /stats - только для владельца"""
-    owner_id = os.getenv("OWNER_ID")
-    user_id = str(update.effective_user.id)
-    
-    if not owner_id or user_id != owner_id:
+    if OWNER_ID is None or update.effective_user.id != OWNER_ID:
         await update.message.reply_text("❌ У тебя нет доступа")
         return
     
     await update.message.reply_text(get_stats_text())
 
+async def _send_upload_action(update: Update) -> None:
+    """Показать статус загрузки (ошибки не критичны)"""
+    try:
+        await update.message.chat.send_action(ChatAction.UPLOAD_VIDEO)
+    except:
+        pass
+
+@contextlib.asynccontextmanager
+async def _download_slot(context: ContextTypes.DEFAULT_TYPE, loading_msg):
+    """Занять слот загрузки; если все заняты — показать место в очереди"""
+    semaphore = context.bot_data['dl_semaphore']
+    if semaphore.locked():
+        context.bot_data['dl_queued'] += 1
+        try:
+            await loading_msg.edit_text(f"⏳ В очереди, позиция {context.bot_data['dl_queued']}")
+        except:
+            pass
+        try:
+            await semaphore.acquire()
+        finally:
+            context.bot_data['dl_queued'] -= 1
+        try:
+            await loading_msg.edit_text("⏳ Ищу трек...")
+        except:
+            pass
+    else:
+        await semaphore.acquire()
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+def _new_dl_pool() -> ProcessPoolExecutor:
+    """Пул процессов для загрузок"""
+    # Загрузки идут в отдельных процессах, чтобы не упираться в GIL.
+    # Число одновременных загрузок ограничено: каждая держит yt-dlp и ffmpeg
+    return ProcessPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS)
+
+async def _run_download(context: ContextTypes.DEFAULT_TYPE, url: str, workdir: Path) -> tuple[bool, str, dict]:
+    """Скачать трек в пуле процессов, пересоздав пул, если он сломан"""
+    pool = context.bot_data['dl_pool']
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            pool, download_soundcloud, url, str(workdir)
+        )
+    except BrokenProcessPool:
+        # Процесс загрузки убит (например, OOM killer во время ffmpeg) — такой пул
+        # больше не принимает задачи. Заменяем его один раз, даже если упали
+        # сразу несколько загрузок
+        if context.bot_data['dl_pool'] is pool:
+            logger.warning("Пул загрузок сломан, создаю новый")
+            context.bot_data['dl_pool'] = _new_dl_pool()
+            pool.shutdown(wait=False)
+        return False, "Загрузка прервалась, попробуй ещё раз", {}
+
+async def _track_exists(http: httpx.AsyncClient, url: str) -> bool:
+    """Дешёвая HEAD-проверка ссылки до запуска yt-dlp"""
+    try:
+        response = await http.head(url if '//' in url else 'https://' + url)
+    except (httpx.HTTPError, httpx.InvalidURL):
+        # Сеть, таймаут или ссылка, которую не разобрал httpx (InvalidURL
+        # не наследует HTTPError), — не повод отказывать, пусть решает yt-dlp
+        return True
+    return response.status_code not in (404, 410)
+
+async def _send_cached_audio(update: Update, key: str, cached: dict) -> bool:
+    """Отправить трек по file_id; False, если file_id недействителен и трек надо качать заново"""
+    send = update.message.reply_voice if cached.get('voice') else update.message.reply_audio
+    try:
+        await send(cached['file_id'], caption=f"✅ {cached['title']}")
+    except BadRequest as e:
+        logger.warning("file_id из кеша недействителен: %s", e)
+        forget_audio(key)
+        return False
+    except TelegramError as e:
+        # Бот заблокирован, таймаут, флуд-контроль — повторная загрузка не поможет
+        logger.warning("Ошибка отправки из кеша: %s", e)
+    return True
+
 async def handle_url(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик ссылок на SoundCloud"""
     url = update.message.text.strip()
     user_id = update.effective_user.id
     username = update.effective_user.username or ""
     
-    # Обновить статистику
-    update_user_stats(user_id, username)
+    # Обновить статистику (запись в базу идёт в фоне)
+    context.bot_data['stats_queue'].put_nowait((user_id, username))
     
     # Проверка SoundCloud
-    if "soundcloud.com" not in url:
+    if not is_soundcloud_url(url):
         await update.message.reply_text("❌ Это не ссылка на SoundCloud.\nПожалуйста, отправь ссылку на трек с SoundCloud.")
         return
     
-    # Статус
-    try:
-        await update.message.chat.send_action(ChatAction.UPLOAD_VIDEO)
-    except:
-        pass
+    key = track_key(url)
+    
+    # Трек уже есть на серверах Telegram — отправляем по file_id без скачивания
+    cached = get_cached_audio(key)
+    if cached and await _send_cached_audio(update, key, cached):
+        return
+    
+    # Статус, сообщение о поиске и проверку ссылки выполняем параллельно
+    _, loading_msg, exists = await asyncio.gather(
+        _send_upload_action(update),
+        update.message.reply_text("⏳ Ищу трек..."),
+        _track_exists(context.bot_data['http'], url),
+    )
+    if not exists:
+        await loading_msg.edit_text("❌ Трек не найден. Проверь ссылку.")
+        return
     
-    loading_msg = await update.message.reply_text("⏳ Ищу трек...")
+    # Этот трек уже качается для другого пользователя — ждём его результата.
+    # Ошибку загрузки передаём всем ждущим; если же file_id не появился по
+    # другой причине, качать заново начнёт только первый проснувшийся, а
+    # остальные увидят его Future на следующем шаге цикла
+    while (inflight := _INFLIGHT.get(key)) is not None:
+        cached, error = await asyncio.shield(inflight)
+        if cached and await _send_cached_audio(update, key, cached):
+            try:
+                await loading_msg.delete()
+            except:
+                pass
+            return
+        if error is not None:
+            await loading_msg.edit_text(f"❌ {error}")
+            return
+    
+    inflight = asyncio.get_running_loop().create_future()
+    _INFLIGHT[key] = inflight
+    error = None
+    
+    # У каждого запроса своя папка: одновременные загрузки одного
+    # и того же трека не перезаписывают и не удаляют чужие файлы
+    workdir = DOWNLOAD_PATH / uuid.uuid4().hex
     
     try:
+        workdir.mkdir()
+        
         # Скачать
-        success, result, info = await asyncio.to_thread(download_soundcloud, url)
+        async with _download_slot(context, loading_msg):
+            success, result, info = await _run_download(context, url, workdir)
         
         if success:
             file_path = Path(result)
-            if file_path.exists():
-                try:
-                    # Получить чистый текст (без подчёркиваний)
-                    clean_title = file_path.stem.replace('_', ' ')
-                    artist = info.get('artist', '')
-                    thumbnail = None
-                    
-                    # Скачать обложку если есть
-                    if info.get('thumbnail'):
-                        thumbnail = await asyncio.to_thread(download_thumbnail, info['thumbnail'])
-                    
-                    with open(file_path, 'rb') as audio_file:
-                        await update.message.reply_audio(
-                            audio_file,
+            try:
+                clean_title = info.get('title') or file_path.stem
+                artist = info.get('artist', '')
+                # Opus Telegram проигрывает только как голосовое сообщение
+                is_voice = file_path.suffix == '.opus'
+                
+                # Файл не читается в память целиком: HTTP-клиент сам
+                # читает его кусками по ходу отправки (read_file_handle — с PTB 21.5)
+                with file_path.open('rb', buffering=AUDIO_READ_BUFFER) as audio_file:
+                    audio = InputFile(
+                        audio_file,
+                        filename=f"{clean_filename(clean_title)}{file_path.suffix}",
+                        read_file_handle=False,
+                    )
+                    if is_voice:
+                        message = await update.message.reply_voice(
+                            audio,
+                            duration=info.get('duration') or None,
+                            caption=f"✅ {clean_title}"
+                        )
+                        sent = message.voice
+                    else:
+                        message = await update.message.reply_audio(
+                            audio,
                             title=clean_title,
                             performer=artist,
-                            thumbnail=thumbnail,
+                            duration=info.get('duration') or None,
                             caption=f"✅ {clean_title}"
                         )
-                    logger.info(f"Файл отправлен: {file_path.name}")
-                    
-                    # Удалить файлы
-                    try:
-                        file_path.unlink()
-                    except:
-                        pass
+                        sent = message.audio
+                logger.info("Файл отправлен: %s", file_path.name)
+                if sent:
+                    remember_audio(key, sent.file_id, clean_title, voice=is_voice)
                     
-                    if thumbnail:
-                        try:
-                            Path(thumbnail).unlink()
-                        except:
-                            pass
-                        
-                except Exception as e:
-                    logger.error(f"Ошибка отправки: {e}")
-                    await update.message.reply_text(f"❌ Ошибка: {str(e)}")
-            else:
-                await update.message.reply_text("❌ Файл не найден")
+            except Exception as e:
+                # Ошибки Telegram (бот заблокирован, файл слишком большой) ожидаемы
+                if isinstance(e, TelegramError):
+                    logger.warning("Ошибка отправки: %s", e)
+                else:
+                    logger.error("Ошибка отправки", exc_info=True)
+                await update.message.reply_text(f"❌ Ошибка: {str(e)}")
         else:
+            error = result
             await update.message.reply_text(f"❌ {result}")
     
     except Exception as e:
-        logger.error(f"Ошибка: {str(e)}")
-        await update.message.reply_text(f"❌ Ошибка: {str(e)}")
+        logger.error("Ошибка обработки %s", url, exc_info=True)
+        error = f"Ошибка: {str(e)}"
+        await update.message.reply_text(f"❌ {error}")
     
     finally:
+        if _INFLIGHT.get(key) is inflight:
+            del _INFLIGHT[key]
+        inflight.set_result((_get_file_cache().get(key), error))
+        # Удаляем файлы в фоне, не задерживая ответ
+        context.application.create_task(asyncio.to_thread(_remove_workdir, workdir))
         try:
             await loading_msg.delete()
         except:
             pass
 
+async def post_init(application: Application) -> None:
+    """Загрузка данных и запуск фоновых задач"""
+    _get_db()
+    _get_file_cache()
+    # Держим ссылку на задачу, иначе её может собрать GC
+    application.bot_data['flush_task'] = asyncio.create_task(_flush_loop())
+    application.bot_data['stats_queue'] = asyncio.Queue()
+    application.bot_data['stats_task'] = asyncio.create_task(
+        _stats_writer(application.bot_data['stats_queue'])
+    )
+    application.bot_data['dl_pool'] = _new_dl_pool()
+    application.bot_data['dl_semaphore'] = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+    application.bot_data['dl_queued'] = 0
+    application.bot_data['http'] = httpx.AsyncClient(
+        follow_redirects=True, timeout=TRACK_CHECK_TIMEOUT
+    )
+
+async def post_shutdown(application: Application) -> None:
+    """Остановка фоновых задач и сохранение данных"""
+    application.bot_data['flush_task'].cancel()
+    # Дожидаемся записи оставшихся событий статистики
+    await application.bot_data['stats_queue'].join()
+    application.bot_data['stats_task'].cancel()
+    # Пишем без проверки флага: фоновая запись могла быть прервана отменой
+    save_file_cache(_get_file_cache())
+    if _DB is not None:
+        _DB.close()
+    application.bot_data['dl_pool'].shutdown(wait=False, cancel_futures=True)
+    await application.bot_data['http'].aclose()
+
 def main():
     """Главная функция"""
-    TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "YOUR_BOT_TOKEN_HERE")
-    
-    if TOKEN == "YOUR_BOT_TOKEN_HERE":
+    if BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
         logger.error("❌ Установи TELEGRAM_BOT_TOKEN")
         return
     
-    application = Application.builder().token(TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        # Обновления обрабатываются параллельно: пока один трек качается,
+        # остальные пользователи получают ответы
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
@@ -262,7 +706,20 @@ def main():
     
     logger.info("🤖 Бот запущен!")
     
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Боту нужны только сообщения — остальные типы обновлений Telegram не присылает
+    allowed_updates = [Update.MESSAGE]
+    
+    if WEBHOOK_URL:
+        application.run_webhook(
+            listen='0.0.0.0',
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=allowed_updates,
+        )
+    else:
+        application.run_polling(allowed_updates=allowed_updates)
 
 if __name__ == '__main__':
     main()